@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""
+Differential checks and throughput benchmark of .workstamps parsing engines
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from os import close, fdopen, remove
+from tempfile import mkstemp
+from time import time
+import random
+
+from days_calc import (
+    ParseError,
+    ReportStore,
+    TextReport,
+    parallel_report_lines,
+    parse_workstamps,
+    report_ranges,
+    stats_by_day)
+
+
+##############################################################################
+# Engines: functions turning a stamp file into the WorkReports that
+# stats_by_day(parse_workstamps(filename)) builds
+##############################################################################
+ENGINES = {}
+# Engines that skip malformed regions instead of raising ParseError
+RECOVERING = set()
+
+
+def register(name, recovers=False):
+    """Registers an engine function under a name"""
+    def decorator(engine):
+        """Adds the engine to ENGINES"""
+        ENGINES[name] = engine
+        if recovers:
+            RECOVERING.add(name)
+        return engine
+    return decorator
+
+
+@register('reference')
+def reference_engine(filename):
+    """The plain parser, what every other engine must match"""
+    return stats_by_day(parse_workstamps(filename))
+
+
+@register('recovering', recovers=True)
+def recovering_engine(filename):
+    """Parser with error recovery, which must match the reference on the
+    file without its malformed regions"""
+    return stats_by_day(parse_workstamps(filename, []))
+
+
+@register('report-store')
+def report_store_engine(filename):
+    """ReportStore fed the file in two appends"""
+    with open(filename, 'r') as infile:
+        lines = infile.readlines()
+    half = len(lines) // 2
+    handle, partial = mkstemp()
+    try:
+        with fdopen(handle, 'w') as outfile:
+            outfile.writelines(lines[:half])
+        store = ReportStore(partial)
+        store.reports()
+        with open(partial, 'a') as outfile:
+            outfile.writelines(lines[half:])
+        store.refresh()
+        return store.reports()
+    finally:
+        remove(partial)
+
+
+##############################################################################
+# Random stamp files covering the edge cases: midnight crossings, multi-day
+# gaps, empty descriptions, blank lines, zero durations, restarttotals and
+# no newline at the end. Invalid files add consecutive restarttotals, starts
+# without work, work without start, malformed timestamps and missing
+# customers
+##############################################################################
+CUSTOMERS = ['acme', 'globex', 'initech', 'x']
+DESCRIPTIONS = ['', 'meeting', 'code review', 'fix  double space', '42']
+# Minutes between stamps. None stands for a random number of minutes
+STEPS = [0, 1, 15, 59, 60, 90, 23 * 60 + 59, None]
+# Days between work days
+GAPS = [0, 1, 1, 1, 2, 5, 31]
+
+
+def stamp(when, info):
+    """A .workstamps line"""
+    return '%s %s' % (when.strftime('%Y-%m-%d %H:%M'), info)
+
+
+def malformed(rng, when):
+    """A line with a broken timestamp or without customer"""
+    line = stamp(when, rng.choice(CUSTOMERS))
+    return rng.choice([
+        line[:11] + 'x' + line[12:],
+        stamp(when, '').strip(),
+        stamp(when, 'start')[:12]])
+
+
+def random_stamps(rng, days=20, invalid=0.0, errors=None, dropped=None):
+    """
+    Lines of a random stamp file with the given number of work days.
+
+    With an invalid probability, malformed sequences are mixed in. The
+    indexes of the lines the parser reports are appended to errors, and the
+    ones a recovering parser drops to dropped. They only differ for a
+    doubled start: the second one is reported, the first one dropped.
+    """
+    errors = [] if errors is None else errors
+    dropped = [] if dropped is None else dropped
+    lines = []
+
+    def bad(line):
+        """Appends a line reported and dropped"""
+        errors.append(len(lines))
+        dropped.append(len(lines))
+        lines.append(line)
+
+    if rng.random() < invalid:
+        bad(rng.choice(['restarttotals', stamp(
+            datetime(2000, 12, 31), rng.choice(CUSTOMERS))]))
+    when = datetime(2001, 1, 1, rng.choice([0, 8, 23]), rng.randint(0, 59))
+    for _ in range(days):
+        if rng.random() < invalid:
+            dropped.append(len(lines))
+            errors.append(len(lines) + 1)
+            lines.append(stamp(when, 'start'))
+        lines.append(stamp(when, 'start'))
+        for _ in range(rng.randint(1, 6)):
+            step = rng.choice(STEPS)
+            if step is None:
+                step = rng.randint(1, 600)
+            when += timedelta(minutes=step)
+            if rng.random() < invalid:
+                bad(malformed(rng, when))
+            info = '%s %s' % (
+                rng.choice(CUSTOMERS), rng.choice(DESCRIPTIONS))
+            lines.append(stamp(when, info.strip()))
+            if rng.random() < 0.1:
+                lines.append('')
+        if rng.random() < 0.3:
+            lines.append('restarttotals')
+            if rng.random() < invalid:
+                bad('restarttotals')
+            elif rng.random() < invalid:
+                bad(stamp(when, rng.choice(CUSTOMERS)))
+        gap = rng.choice(GAPS)
+        when = datetime(when.year, when.month, when.day) + timedelta(
+            days=gap, hours=rng.choice([0, 8, 23]), minutes=rng.randint(0, 59))
+    return lines
+
+
+def without_bad_regions(lines, dropped):
+    """
+    The lines a recovering parser keeps: without the dropped lines and the
+    work after them up to the next start or restarttotals, without the
+    starts left with no work and without the restarttotals left with no
+    report
+    """
+    dropped = set(dropped)
+    kept = []
+    skipping = False
+    for index, line in enumerate(lines):
+        if index in dropped:
+            skipping = True
+            continue
+        if line.endswith(' start') or line == 'restarttotals':
+            skipping = False
+        if not skipping:
+            kept.append(line)
+    clean = []
+    for line in kept:
+        if line.endswith(' start') or line == 'restarttotals':
+            while clean and not clean[-1]:
+                clean.pop()
+            if clean and clean[-1].endswith(' start'):
+                clean.pop()
+            if line == 'restarttotals' and (
+                    not clean or clean[-1] == 'restarttotals'):
+                continue
+        clean.append(line)
+    return clean
+
+
+def write_stamps(filename, lines, final_newline=True):
+    """Writes stamp lines to a file"""
+    with open(filename, 'w') as outfile:
+        outfile.write('\n'.join(lines))
+        if final_newline and lines:
+            outfile.write('\n')
+
+
+def write_case(seed, filename, clean_filename, invalid=0.02):
+    """Writes a random stamp file and the same file without its bad
+    regions. Odd seeds leave out the newline at the end"""
+    rng = random.Random(seed)
+    dropped = []
+    lines = random_stamps(rng, invalid=invalid, dropped=dropped)
+    final_newline = seed % 2 == 0
+    write_stamps(filename, lines, final_newline)
+    write_stamps(
+        clean_filename, without_bad_regions(lines, dropped), final_newline)
+
+
+##############################################################################
+# Comparing an engine against the reference
+##############################################################################
+def outcome(engine, filename):
+    """
+    What an engine gives for a file: the ParseError line and message, or the
+    reports with their day and report customer totals and the text report
+    """
+    try:
+        reports = engine(filename)
+    except ParseError as error:
+        return 'error', error.lineno, error.message
+    return (
+        'reports', reports,
+        [[day.customers for day in report] for report in reports],
+        [report.customers for report in reports],
+        TextReport(reports).text)
+
+
+def differs(name, filename, clean_filename=None):
+    """True when the named engine does not match the reference. Recovering
+    engines are matched with the reference on the clean file when given"""
+    expected = filename
+    if name in RECOVERING and clean_filename is not None:
+        expected = clean_filename
+    return outcome(ENGINES[name], filename) != \
+        outcome(reference_engine, expected)
+
+
+##############################################################################
+# Command line: correctness over many random files and speed on a big one
+##############################################################################
+def cmdline_arguments():
+    """Parse the command line arguments via argparse"""
+    parser = ArgumentParser(description='parsing engines benchmark')
+    parser.add_argument(
+        'engines', nargs='*', default=None,
+        help='Engines to run (default: all)')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='First random seed (default: 0)')
+    parser.add_argument(
+        '--files', type=int, default=200,
+        help='Random files checked per engine (default: 200)')
+    parser.add_argument(
+        '--days', type=int, default=20000,
+        help='Work days in the throughput file (default: 20000)')
+    parser.add_argument(
+        '--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+        help='Worker counts timed reporting the throughput file '
+             '(default: 1 2 4 8)')
+    return parser.parse_args()
+
+
+def report_scaling(filename, worker_counts):
+    """Seconds to parse and render the text report of a file by number of
+    workers. One worker is the sequential report"""
+    timings = []
+    for workers in worker_counts:
+        began = time()
+        if workers == 1:
+            _ = TextReport(reference_engine(filename)).lines
+        else:
+            _ = list(parallel_report_lines(
+                filename, report_ranges(filename), workers))
+        timings.append((workers, time() - began))
+    return timings
+
+
+def run_from_command_line():
+    """Checks and times the engines with command line arguments"""
+    args = cmdline_arguments()
+    names = args.engines or sorted(ENGINES)
+    handle, filename = mkstemp()
+    close(handle)
+    handle, clean_filename = mkstemp()
+    close(handle)
+    try:
+        failures = dict((name, 0) for name in names)
+        for seed in range(args.seed, args.seed + args.files):
+            write_case(seed, filename, clean_filename)
+            for name in names:
+                if differs(name, filename, clean_filename):
+                    failures[name] += 1
+                    print('%s differs with seed %d' % (name, seed))
+
+        lines = random_stamps(random.Random(args.seed), args.days)
+        write_stamps(filename, lines)
+        print('%-15s %8s %10s %12s' % (
+            'engine', 'diffs', 'seconds', 'lines/s'))
+        for name in names:
+            began = time()
+            ENGINES[name](filename)
+            elapsed = time() - began
+            print('%-15s %8d %10.3f %12d' % (
+                name, failures[name], elapsed, len(lines) / elapsed))
+        print('%-15s %10s' % ('report workers', 'seconds'))
+        for workers, elapsed in report_scaling(filename, args.workers):
+            print('%-15d %10.3f' % (workers, elapsed))
+    finally:
+        remove(filename)
+        remove(clean_filename)
+    return 1 if any(failures.values()) else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(run_from_command_line())
@@ -2,18 +2,46 @@
 """
 .workstamps report formatter
 """
+# One file, as the command is used straight from a download of the repo
+# pylint: disable=too-many-lines
 from __future__ import print_function
 from argparse import ArgumentParser
-from datetime import datetime
-from os.path import expanduser
+from datetime import date, datetime, timedelta
+from heapq import merge
+from os import fstat, rename, stat
+from os.path import abspath, basename, exists, expanduser, sep
+from tempfile import TemporaryFile
+from time import sleep
+import json
+import sys
 
 
 ##############################################################################
 # Code related to splitting the .workstamps.txt file into tokens with
 # information: start, restart totals and work items
 ##############################################################################
+class ParseError(RuntimeError):
+    """Malformed .workstamps content at a line, of a source when known. The
+    line is None when unknown"""
+    def __init__(self, message, lineno, source=None):
+        super(ParseError, self).__init__(message, lineno)
+        self.message = message
+        self.lineno = lineno
+        self.source = source
+
+    def __str__(self):
+        """Error message for humans, counting lines from 1"""
+        error = self.message
+        if self.lineno is not None:
+            error = 'line {0}: {1}'.format(self.lineno + 1, error)
+        if self.source is None:
+            return error
+        return '{0}: {1}'.format(self.source, error)
+
+
 class Item(object):
     """Generic processing item for parsing .workstamps file"""
+    is_malformed = False
     is_restart = False
     is_start = False
     is_work = False
@@ -28,6 +56,15 @@ class Item(object):
             other.is_work == self.is_work
 
 
+class Malformed(Item):
+    """Place of a malformed line that was skipped in .workstamps file"""
+    is_malformed = True
+
+    def __repr__(self):
+        """Debugging helper representation"""
+        return 'line {0}: malformed'.format(self.lineno)
+
+
 class RestartTotals(Item):
     """Restart Totals Item in .workstamps file"""
     is_restart = True
@@ -82,26 +119,71 @@ class Work(Start):
             super(Work, self).__eq__(other)
 
 
-def itemify(filename):
-    """Split a .workstamp file into items"""
+class SymbolTable(object):
+    """
+    Shares one string object per distinct customer and description.
+
+    Real histories have a handful of customers and many repeated
+    descriptions, so every work line reuses strings already seen instead of
+    keeping its own copy. Customer totals dicts then hash and compare those
+    shared objects by identity.
+    """
+    def __init__(self):
+        self.__strings = {}
+
+    def intern(self, text):
+        """Returns the shared copy of text"""
+        return self.__strings.setdefault(text, text)
+
+    def __len__(self):
+        return len(self.__strings)
+
+
+def itemify(filename, errors=None):
+    """
+    Split a .workstamp file into items.
+
+    Malformed lines raise ParseError. With an errors list they are appended
+    there and a Malformed item takes their place.
+    """
     with open(filename, 'r') as infile:
-        lineno = 0
-        for line in infile:
-            line = line.strip()
-            if line:
-                yield item_factory(lineno, line)
-            lineno += 1
+        for item in itemify_lines(enumerate(infile), SymbolTable(), errors):
+            yield item
+
+
+def itemify_lines(lines, symbols, errors=None):
+    """Items from (lineno, line) pairs, skipping blank lines"""
+    for lineno, line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = item_factory(lineno, line, symbols)
+        except ParseError as error:
+            if errors is None:
+                raise
+            errors.append(error)
+            item = Malformed(lineno)
+        yield item
 
 
-def item_factory(lineno, line):
+def item_factory(lineno, line, symbols=None):
     """Build the right item from a .workstamp line"""
     if line == 'restarttotals':
         return RestartTotals(lineno)
     date_time = line[:16]
     info = line[17:]
-    if info == 'start':
-        return Start(lineno, date_time)
-    return Work(lineno, date_time, *info.split(' ', 1))
+    if not info:
+        raise ParseError('missing start or customer', lineno)
+    try:
+        if info == 'start':
+            return Start(lineno, date_time)
+        info = info.split(' ', 1)
+        if symbols is not None:
+            info = [symbols.intern(text) for text in info]
+        return Work(lineno, date_time, *info)
+    except ValueError:
+        raise ParseError('malformed date and time %r' % date_time, lineno)
 
 
 ##############################################################################
@@ -136,7 +218,7 @@ class WorkItem(object):
 def initial_state(context, item):
     """Initial state for the parser"""
     if not item.is_start:
-        raise RuntimeError('first line should be a start', item)
+        raise ParseError('first line should be a start', item.lineno)
     context.start_period = item.when
     return expect_work
 
@@ -144,7 +226,8 @@ def initial_state(context, item):
 def expect_work(context, item):
     """Expecting work items state"""
     if not item.is_work:
-        raise RuntimeError('start must be followed by some activity', item)
+        raise ParseError(
+            'start must be followed by some activity', item.lineno)
     context.add_item(item)
     return working
 
@@ -161,47 +244,137 @@ def working(context, item):
     raise RuntimeError('This shouldnt happen %s' % item)
 
 
-class ParserContext(object):
-    """Holds parsing context during parsing"""
+def skipping(context, item):
+    """Recovery state after an error: drops items until a start or
+    restarttotals"""
+    if item.is_start:
+        return initial_state(context, item)
+    elif item.is_restart:
+        context.add_current_report()
+        return initial_state
+    return skipping
+
+
+# Parser states by name, to save and restore a parse in progress
+PARSER_STATES = dict(
+    (state.__name__, state)
+    for state in (initial_state, expect_work, working, skipping))
+
+
+def run_states(context, items, errors=None, state=initial_state):
+    """
+    Feeds the items through the parser states, from the given one.
+
+    Errors raise ParseError. With an errors list they are appended there and
+    parsing resumes at the next start or restarttotals. Malformed items,
+    already in the errors list, break the period the same way.
+    """
+    for item in items:
+        if item.is_malformed:
+            state = skipping
+            continue
+        try:
+            state = state(context, item)
+        except ParseError as error:
+            if errors is None:
+                raise
+            errors.append(error)
+            state = skipping(context, item)
+    return state
+
+
+class PeriodContext(object):
+    """
+    Parser context following the periods: each work item runs from the end
+    of the previous one. Subclasses get every WorkItem in add_work and the
+    end of each report in close_report.
+    """
     def __init__(self):
-        self.__stack = []
-        self.__reports = []
         self.start_period = None
 
     def add_current_report(self):
+        """Closes the current period"""
+        self.close_report()
+        self.start_period = None
+
+    def add_item(self, line_item):
+        """Adds a processed work item"""
+        item = WorkItem(self.start_period, line_item)
+        self.start_period = item.end
+        self.add_work(item)
+
+    def add_work(self, item):
+        """A WorkItem was parsed"""
+
+    def close_report(self):
+        """The current report ended"""
+
+
+class CheckContext(PeriodContext):
+    """Parser context that only follows the periods, for validating files"""
+    def add_item(self, line_item):
+        """Moves the period start to the end of the work item, without
+        building it"""
+        self.start_period = line_item.when
+
+
+class ParserContext(PeriodContext):
+    """Holds parsing context during parsing, from the given reports, work
+    items of the current report and period start"""
+    def __init__(self, reports=(), current=(), start_period=None):
+        super(ParserContext, self).__init__()
+        self.__stack = list(current)
+        self.__reports = list(reports)
+        self.start_period = start_period
+
+    def close_report(self):
         """Adds the current work items as a group and start a new work item
         list"""
         if not self.__stack:
             return
         self.__reports.append(self.__stack)
         self.__stack = []
-        self.start_period = None
 
-    def add_item(self, line_item):
+    def add_work(self, item):
         """Adds a processed work item"""
-        item = WorkItem(self.start_period, line_item)
         self.__stack.append(item)
-        self.start_period = item.end
 
     @property
     def reports(self):
         """Reports stored during parsing"""
         return self.__reports
 
+    @property
+    def current(self):
+        """Work items of the report still being parsed"""
+        return self.__stack
+
+    def copy(self):
+        """A context that goes on parsing without changing this one"""
+        return ParserContext(self.__reports, self.__stack, self.start_period)
 
-def parse_workstamps(filename):
+
+def parse_workstamps(filename, errors=None):
     """
     Parsing the file returns a list of lists. Each sublist contains
     WorkItems inside a restarttotal block/report
+
+    With an errors list, malformed regions are recorded there and skipped.
     """
-    state = initial_state
     context = ParserContext()
-    for item in itemify(filename):
-        state = state(context, item)
+    run_states(context, itemify(filename, errors), errors)
     context.add_current_report()
     return context.reports
 
 
+def check_workstamps(filename):
+    """All the errors in a .workstamps file, found in one pass without
+    building reports"""
+    errors = []
+    run_states(CheckContext(), itemify(filename, errors), errors)
+    return errors
+
+
 ##############################################################################
 # Filtering and transforming the data from the parser: specific customer,
 # specific report and adding statistics
@@ -291,6 +464,555 @@ class WorkReport(list):
         return totals
 
 
+##############################################################################
+# Reusable report store: parses a file once and then only what gets appended,
+# answering queries with the WorkReport/WorkDay structures
+##############################################################################
+class StampLog(object):
+    """
+    Reads the lines appended to a .workstamps file since the last read.
+
+    Remembers the file inode, the byte offset and the last complete line
+    read. A replaced or truncated file, or one where that last line changed,
+    has to be read again from the start. Edits before that line which keep
+    it in place are not noticed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.inode = None
+        self.offset = 0
+        self.lineno = 0
+        self.tail = b''
+        self.pending = None
+
+    def is_continuation(self):
+        """True when the file is the one read so far plus appended lines"""
+        with open(self.filename, 'rb') as infile:
+            if self.inode not in (None, fstat(infile.fileno()).st_ino):
+                return False
+            infile.seek(self.offset - len(self.tail))
+            return infile.read(len(self.tail)) == self.tail
+
+    def lines(self):
+        """
+        (lineno, line) pairs for the complete lines appended since the last
+        read. A last line without newline is kept as the pending pair
+        instead, and read again by the next read.
+        """
+        self.pending = None
+        with open(self.filename, 'rb') as infile:
+            self.inode = fstat(infile.fileno()).st_ino
+            infile.seek(self.offset)
+            for raw in infile:
+                if not raw.endswith(b'\n'):
+                    self.pending = self.lineno, raw.decode('utf-8')
+                    return
+                self.offset += len(raw)
+                self.tail = raw
+                yield self.lineno, raw.decode('utf-8')
+                self.lineno += 1
+
+
+def file_key(filename):
+    """Identifies a file version: inode, size and modification time"""
+    info = stat(filename)
+    return info.st_ino, info.st_size, info.st_mtime
+
+
+class StampParse(object):
+    """
+    Parse of a growing stamp file in progress: where the file was read up
+    to, and the parser context and state there.
+    """
+    def __init__(self, filename):
+        self.log = StampLog(filename)
+        self.symbols = SymbolTable()
+        self.context = ParserContext()
+        self.state = initial_state
+
+    def advance(self):
+        """Parses the lines appended since the last call. Returns the
+        context with a last line without newline parsed too, on a copy so
+        it is parsed again once complete"""
+        self.state = run_states(
+            self.context, itemify_lines(self.log.lines(), self.symbols),
+            state=self.state)
+        if self.log.pending is None:
+            return self.context
+        context = self.context.copy()
+        run_states(
+            context, itemify_lines([self.log.pending], self.symbols),
+            state=self.state)
+        return context
+
+
+class ReportStore(object):
+    """
+    Stamp file reports kept in memory between queries.
+
+    The file is parsed on the first query. Later queries parse again only
+    when the file changed, and only the appended lines when it just grew
+    (see StampLog and StampParse).
+    Queries return the stored WorkReport/WorkDay structures, not copies.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.__reset()
+
+    def __reset(self):
+        """Forgets everything parsed"""
+        self.__key = None
+        self.__parse = StampParse(self.filename)
+        self.__done = []
+        self.__reports = []
+
+    def refresh(self):
+        """Parses whatever changed in the file since the last refresh"""
+        key = file_key(self.filename)
+        if key == self.__key:
+            return
+        if not self.__parse.log.is_continuation():
+            self.__reset()
+        try:
+            context = self.__parse.advance()
+        except ParseError:
+            self.__reset()
+            raise
+        self.__key = key
+
+        parsed = self.__parse.context.reports
+        self.__done.extend(stats_by_day(parsed[len(self.__done):]))
+        self.__reports = list(self.__done)
+        self.__reports.extend(
+            stats_by_day(context.reports[len(self.__done):]))
+        if context.current:
+            self.__reports.extend(stats_by_day([context.current]))
+
+    def reports(self):
+        """All the reports, oldest first"""
+        self.refresh()
+        return self.__reports
+
+    def report(self, index):
+        """A report starting from 0 the latest, 1 the previous, ..."""
+        return self.reports()[-1 * (index + 1)]
+
+    def customers(self):
+        """Sorted names of all the customers"""
+        names = set()
+        for report in self.reports():
+            names.update(report.customers)
+        return sorted(names)
+
+    def days(self, start=None, end=None):
+        """Work days between the start and end dates, both included"""
+        return [
+            day for report in self.reports() for day in report
+            if (start is None or start <= day.date) and
+            (end is None or day.date <= end)]
+
+    def totals(self, start=None, end=None):
+        """Customer totals for the days between start and end dates"""
+        if start is None and end is None:
+            reports = self.reports()
+        else:
+            reports = [WorkReport(self.days(start, end))]
+        totals = {}
+        for report in reports:
+            for customer, total in report.customers.items():
+                if customer not in totals:
+                    totals[customer] = total
+                    continue
+                totals[customer] += total
+        return totals
+
+
+##############################################################################
+# Calendar rollups: customer totals per week, month or year kept in a cache
+# file and updated with the lines appended to the stamp file
+##############################################################################
+def week_bucket(day):
+    """ISO week of a date, like 2013-W45"""
+    year, week = day.isocalendar()[:2]
+    return '%04d-W%02d' % (year, week)
+
+
+def month_bucket(day):
+    """Month of a date, like 2013-11"""
+    return '%04d-%02d' % (day.year, day.month)
+
+
+def year_bucket(day):
+    """Year of a date, like 2013"""
+    return '%04d' % day.year
+
+
+BUCKETS = {
+    'week': week_bucket,
+    'month': month_bucket,
+    'year': year_bucket}
+
+
+class RollupContext(PeriodContext):
+    """Parser context adding work minutes to the calendar buckets of the
+    work date, for each customer"""
+    def __init__(self, rollups=None):
+        super(RollupContext, self).__init__()
+        if rollups is None:
+            rollups = dict((group, {}) for group in BUCKETS)
+        self.rollups = rollups
+
+    def add_work(self, item):
+        """Adds a processed work item to its buckets"""
+        minutes = item.duration.days * 1440 + item.duration.seconds // 60
+        for group, bucket_of in BUCKETS.items():
+            totals = self.rollups[group].setdefault(bucket_of(item.date), {})
+            totals[item.customer] = totals.get(item.customer, 0) + minutes
+
+
+class RollupCache(object):
+    """
+    Calendar rollups of a stamp file saved in a JSON cache file.
+
+    The cache remembers where the stamp file was read up to and the parser
+    state there. Appended lines only update the newest buckets; any other
+    change to the stamp file rebuilds the cache (see StampLog). A last line
+    without newline is added to the returned rollups but not saved, so it
+    is read again by the next call.
+    """
+    version = 2
+
+    def __init__(self, filename, cache_filename):
+        self.filename = filename
+        self.cache_filename = cache_filename
+
+    def __load(self):
+        """Cached data for this stamp file, or None"""
+        if not exists(self.cache_filename):
+            return None
+        with open(self.cache_filename, 'r') as infile:
+            try:
+                cache = json.load(infile)
+            except ValueError:
+                return None
+        if cache.get('version') != self.version or \
+                cache.get('file') != abspath(self.filename):
+            return None
+        return cache
+
+    def __save(self, cache):
+        """Replaces the cache file"""
+        temporary = self.cache_filename + '.tmp'
+        with open(temporary, 'w') as outfile:
+            json.dump(cache, outfile)
+        rename(temporary, self.cache_filename)
+
+    def rollups(self):
+        """Customer minutes by group (week, month, year) and bucket"""
+        key = list(file_key(self.filename))
+        cache = self.__load()
+        if cache is not None and cache['key'] == key:
+            return cache['rollups']
+
+        log = StampLog(self.filename)
+        context = RollupContext()
+        state = initial_state
+        if cache is not None:
+            log.inode = cache['inode']
+            log.offset = cache['offset']
+            log.lineno = cache['lineno']
+            log.tail = cache['tail'].encode('utf-8')
+            if log.is_continuation():
+                context = RollupContext(cache['rollups'])
+                state = PARSER_STATES[cache['state']]
+                if cache['start_period'] is not None:
+                    context.start_period = datetime.strptime(
+                        cache['start_period'], '%Y-%m-%d %H:%M')
+            else:
+                log = StampLog(self.filename)
+
+        state = run_states(
+            context, itemify_lines(log.lines(), SymbolTable()), state=state)
+
+        start_period = context.start_period
+        if start_period is not None:
+            start_period = start_period.strftime('%Y-%m-%d %H:%M')
+        self.__save({
+            'version': self.version,
+            'file': abspath(self.filename),
+            'key': key if log.pending is None else None,
+            'inode': log.inode,
+            'offset': log.offset,
+            'lineno': log.lineno,
+            'tail': log.tail.decode('utf-8'),
+            'state': state.__name__,
+            'start_period': start_period,
+            'rollups': context.rollups})
+        if log.pending is not None:
+            run_states(
+                context, itemify_lines([log.pending], SymbolTable()),
+                state=state)
+        return context.rollups
+
+
+##############################################################################
+# External aggregation: customer totals per day for histories larger than
+# memory, spilling sorted partial totals to temporary files
+##############################################################################
+# Rough bytes of memory used by one (report, day, customer) aggregate
+AGGREGATE_SIZE = 256
+# Spill files of the same level merged into one of the next level
+MERGE_WIDTH = 16
+
+
+class SpillingContext(PeriodContext):
+    """
+    Parser context adding work minutes per report, day and customer.
+
+    Keeps no work items. When the aggregates reach max_memory bytes they
+    are written sorted to a temporary file and memory starts empty again.
+    Spills are (level, file) pairs: MERGE_WIDTH files of one level are
+    merged into one file of the next, so every aggregate is rewritten once
+    per level and the open files grow with the number of levels only.
+    """
+    def __init__(self, max_memory, customer=None):
+        super(SpillingContext, self).__init__()
+        self.customer = customer
+        self.max_aggregates = max(1, max_memory // AGGREGATE_SIZE)
+        self.reports = 0
+        self.aggregates = {}
+        self.spills = []
+        self.__in_report = False
+
+    def close_report(self):
+        """Counts the current report"""
+        if self.__in_report:
+            self.reports += 1
+            self.__in_report = False
+
+    def add_work(self, item):
+        """Adds a processed work item to its day and customer total"""
+        self.__in_report = True
+        if self.customer is not None and item.customer != self.customer:
+            return
+        key = (self.reports, item.date.toordinal(), item.customer)
+        minutes = item.duration.days * 1440 + item.duration.seconds // 60
+        self.aggregates[key] = self.aggregates.get(key, 0) + minutes
+        if len(self.aggregates) >= self.max_aggregates:
+            self.spill()
+
+    def spill(self):
+        """Writes the aggregates in memory, sorted, to a temporary file"""
+        self.spills.append((0, write_spill(sorted(self.aggregates.items()))))
+        self.aggregates = {}
+        level = 0
+        while len(self.spills) >= MERGE_WIDTH and all(
+                spill_level == level
+                for spill_level, _ in self.spills[-MERGE_WIDTH:]):
+            runs = [spill for _, spill in self.spills[-MERGE_WIDTH:]]
+            del self.spills[-MERGE_WIDTH:]
+            merged = write_spill(summed(
+                merge(*[read_spill(spill) for spill in runs])))
+            for spill in runs:
+                spill.close()
+            level += 1
+            self.spills.append((level, merged))
+
+    def close(self):
+        """Removes the temporary files"""
+        for _, spill in self.spills:
+            spill.close()
+        self.spills = []
+
+
+def write_spill(aggregates):
+    """Temporary file with sorted ((report, day, customer), minutes) pairs"""
+    spill = TemporaryFile(mode='w+')
+    for (report, day, customer), minutes in aggregates:
+        spill.write('%d\t%d\t%d\t%s\n' % (report, day, minutes, customer))
+    spill.seek(0)
+    return spill
+
+
+def read_spill(spill):
+    """Sorted ((report, day, customer), minutes) pairs from a spill file"""
+    for line in spill:
+        report, day, minutes, customer = line.rstrip('\n').split('\t', 3)
+        yield (int(report), int(day), customer), int(minutes)
+
+
+def merged_aggregates(context):
+    """
+    Merges the spill files and the aggregates still in memory into sorted
+    (report, day, customer, minutes) totals
+    """
+    sources = [read_spill(spill) for _, spill in context.spills]
+    sources.append(iter(sorted(context.aggregates.items())))
+    for key, minutes in summed(merge(*sources)):
+        yield key + (minutes,)
+
+
+def summed(aggregates):
+    """Adds up the minutes of equal keys in sorted (key, minutes) pairs"""
+    current, total = None, 0
+    for key, minutes in aggregates:
+        if key != current:
+            if current is not None:
+                yield current, total
+            current, total = key, 0
+        total += minutes
+    if current is not None:
+        yield current, total
+
+
+def aggregate_workstamps(filename, max_memory, customer=None):
+    """Parses the file into a SpillingContext, keeping at most about
+    max_memory bytes of aggregates in memory"""
+    context = SpillingContext(max_memory, customer)
+    with open(filename, 'r') as infile:
+        run_states(context, itemify_lines(enumerate(infile), None))
+    context.add_current_report()
+    return context
+
+
+##############################################################################
+# Merged timeline: work items of several sorted stamp files interleaved by
+# time, streaming with one parser state per file
+##############################################################################
+class StreamContext(PeriodContext):
+    """Parser context handing out the work items as they are parsed"""
+    def __init__(self):
+        super(StreamContext, self).__init__()
+        self.parsed = []
+
+    def add_work(self, item):
+        """Adds a processed work item, to be taken from parsed"""
+        self.parsed.append(item)
+
+
+def stream_work_items(filename):
+    """Streams the WorkItems of a file in order"""
+    context = StreamContext()
+    state = initial_state
+    for item in itemify(filename):
+        state = state(context, item)
+        for work in context.parsed:
+            yield work
+        del context.parsed[:]
+
+
+def tagged_work_items(index, user, filename):
+    """(end, index, user, WorkItem) for the work items of a file. The
+    index keeps items of different files from ever comparing themselves.
+    Parsing errors name the user and file"""
+    try:
+        for item in stream_work_items(filename):
+            yield item.end, index, user, item
+    except ParseError as error:
+        error.source = '%s (%s)' % (user, filename)
+        raise
+
+
+def merged_timeline(sources):
+    """
+    Interleaves the work items of (user, filename) sources, each one
+    already sorted by time, into (user, WorkItem) pairs ordered by end
+    time. Holds one pending item per source.
+    """
+    streams = [
+        tagged_work_items(index, user, filename)
+        for index, (user, filename) in enumerate(sources)]
+    for _, _, user, item in merge(*streams):
+        yield user, item
+
+
+def timeline_source(argument):
+    """(user, filename) from a [USER=]FILE argument. The user defaults to
+    the file name. A user name has no path separator, so a=b.txt is user a,
+    while ./a=b.txt is a file"""
+    user, equals, filename = argument.partition('=')
+    if not equals or '/' in user or sep in user:
+        return basename(argument), argument
+    return user, filename
+
+
+##############################################################################
+# Current status: today's totals and the open interval, reading only the end
+# of the stamp file
+##############################################################################
+# Bytes read at once when reading a stamp file backwards
+TAIL_BLOCK = 4096
+
+
+def reversed_lines(filename, block=TAIL_BLOCK):
+    """The lines of a file from the last one to the first, reading it
+    backwards in blocks"""
+    with open(filename, 'rb') as infile:
+        infile.seek(0, 2)
+        position = infile.tell()
+        rest = b''
+        while position > 0:
+            size = min(block, position)
+            position -= size
+            infile.seek(position)
+            lines = (infile.read(size) + rest).split(b'\n')
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                yield line.decode('utf-8')
+        yield rest.decode('utf-8')
+
+
+def day_tail(filename, day):
+    """
+    The last lines of a file needed for the work of a day: back to the last
+    stamp before that day, or the whole file when there is none. Always
+    includes the last stamp.
+    """
+    before = day.isoformat()
+    lines = []
+    for line in reversed_lines(filename):
+        line = line.strip()
+        if not line:
+            continue
+        lines.append(line)
+        if line != 'restarttotals' and line[:10] < before:
+            break
+    lines.reverse()
+    return lines
+
+
+def current_status(filename, now):
+    """
+    (last stamp time, open interval start, customer totals) for the day of
+    now. The open interval start is None after a restarttotals.
+
+    Only the end of the file is read, so a ParseError names the bad line by
+    its text, without line number.
+    """
+    tail = day_tail(filename, now.date())
+    try:
+        items = [item_factory(index, line) for index, line in enumerate(tail)]
+        while items and items[0].is_restart:
+            items.pop(0)
+        stamps = [item.when for item in items if not item.is_restart]
+        context = ParserContext()
+        state = initial_state
+        if items and items[0].is_work:
+            # The work stamp before the day only marks where the next work
+            # began
+            context.start_period = items.pop(0).when
+            state = working
+        state = run_states(context, items, state=state)
+    except ParseError as error:
+        raise ParseError(
+            '%s at %r' % (error.message, tail[error.lineno]), None)
+    since = None if state is initial_state else context.start_period
+    today = [
+        work for report in context.reports + [context.current]
+        for work in report if work.date == now.date()]
+    return stamps[-1] if stamps else None, since, WorkDay(today).customers
+
+
 ##############################################################################
 # Output in text. Build report lines and format timedeltas
 ##############################################################################
@@ -334,24 +1056,32 @@ def day_report(day):
     return report
 
 
+def report_lines(report):
+    """Text lines for a report: its days and the restart totals summary"""
+    lines = []
+    for day in report:
+        lines.extend(day_report(day))
+    lines.extend(customer_summary(report.customers))
+    return lines
+
+
 class TextReport(object):
     """Text report from stats per day data"""
     def __init__(self, report_data):
         self.report_data = report_data
         self.__lines = None
 
+    def __iter_lines(self):
+        """Report lines, one report after another"""
+        for report in self.report_data:
+            for line in report_lines(report):
+                yield line
+
     @property
     def lines(self):
         """Get the report lines as a list of strings"""
-        if self.__lines is not None:
-            return self.__lines
-
-        self.__lines = []
-        for report in self.report_data:
-            for day in report:
-                self.__lines.extend(day_report(day))
-            self.__lines.extend(customer_summary(report.customers))
-
+        if self.__lines is None:
+            self.__lines = list(self.__iter_lines())
         return self.__lines
 
     @property
@@ -359,10 +1089,249 @@ class TextReport(object):
         """Get the report as one string"""
         return '\n'.join(self.lines)
 
+    def write(self, outfile):
+        """Writes the report lines as they are rendered, without keeping
+        them"""
+        for line in self.__iter_lines():
+            outfile.write(line + '\n')
+
+
+##############################################################################
+# Parallel reports: worker processes parse and render parts of the file that
+# end at a restarttotals, so only file offsets and text lines are sent
+# between processes
+##############################################################################
+# Parsing and rendering go to worker processes above this number of reports
+PARALLEL_THRESHOLD = 500
+# Reports a worker parses and renders at once
+PARALLEL_CHUNKSIZE = 16
+
+
+def report_ranges(filename):
+    """
+    (offset, size, lineno) of the parts of a file ending at a restarttotals
+    line or at the end of the file. The parser is in its initial state after
+    a restarttotals, so each part parses on its own.
+    """
+    ranges = []
+    offset = size = lineno = 0
+    with open(filename, 'rb') as infile:
+        for index, line in enumerate(infile):
+            size += len(line)
+            if line.strip() == b'restarttotals':
+                ranges.append((offset, size, lineno))
+                offset, size, lineno = offset + size, 0, index + 1
+    if size:
+        ranges.append((offset, size, lineno))
+    return ranges
+
+
+def joined_ranges(ranges, count):
+    """Consecutive ranges joined count at a time"""
+    for index in range(0, len(ranges), count):
+        group = ranges[index:index + count]
+        yield group[0][0], sum(size for _, size, _ in group), group[0][2]
+
+
+def render_range(job):
+    """
+    Parses and renders a part of a stamp file: its report lines and, when
+    recovering, its errors. Runs in the worker processes.
+    """
+    filename, offset, size, lineno, customer, recover = job
+    with open(filename, 'rb') as infile:
+        infile.seek(offset)
+        text = infile.read(size).decode('utf-8')
+    errors = [] if recover else None
+    context = ParserContext()
+    lines = enumerate(text.split('\n'), lineno)
+    run_states(context, itemify_lines(lines, SymbolTable(), errors), errors)
+    context.add_current_report()
+    reports = stats_by_day(filter_customer(customer, context.reports))
+    return [line for report in reports for line in report_lines(report)], \
+        errors or []
+
+
+def bounded(items, slots, stop):
+    """Yields the items, each one taking a slot first. Ends when stop is
+    set"""
+    for item in items:
+        slots.acquire()
+        if stop.is_set():
+            return
+        yield item
+
+
+def parallel_report_lines(filename, ranges, workers, customer=None,
+                          errors=None):
+    """
+    Report lines of the report_ranges of a stamp file parsed and rendered by
+    a worker pool, in file order. With an errors list, malformed regions are
+    recorded there and skipped. Without, the first ParseError is raised once
+    the lines before it are yielded.
+
+    A part of the file takes a slot when handed out and frees it once
+    written, so at most two parts per worker are rendered and waiting.
+    """
+    # Only long reports pay for importing processes and threads
+    # pylint: disable=import-outside-toplevel
+    from multiprocessing import Pool
+    from threading import Event, Semaphore
+    jobs = (
+        (filename, offset, size, lineno, customer, errors is not None)
+        for offset, size, lineno in joined_ranges(
+            ranges, PARALLEL_CHUNKSIZE))
+    slots = Semaphore(workers * 2)
+    stop = Event()
+    pool = Pool(workers)
+    try:
+        for lines, part_errors in pool.imap(
+                render_range, bounded(jobs, slots, stop)):
+            slots.release()
+            if errors is not None:
+                errors.extend(part_errors)
+            for line in lines:
+                yield line
+    finally:
+        stop.set()
+        slots.release()
+        pool.terminate()
+        pool.join()
+
+
+def rollup_lines(buckets, customer=None):
+    """Text lines for the customer totals of calendar buckets"""
+    lines = []
+    for bucket in sorted(buckets):
+        totals = dict(
+            (name, timedelta(minutes=minutes))
+            for name, minutes in buckets[bucket].items()
+            if customer is None or name == customer)
+        if not totals:
+            continue
+        lines.append('---------- %s ----------' % bucket)
+        lines.extend(customer_totals(totals))
+    return lines
+
+
+def aggregate_lines(aggregates, report=None):
+    """
+    Text lines for the merged day totals of aggregate_workstamps, with one
+    customer summary per report. Only holds one report totals at a time.
+    """
+    current, day, totals, day_totals = None, None, {}, {}
+
+    def close_day():
+        """Lines for the day being read"""
+        if not day_totals:
+            return []
+        lines = ['---------- %s ----------' % date.fromordinal(day)]
+        lines.extend(customer_totals(day_totals))
+        return lines
+
+    for report_index, ordinal, customer, minutes in aggregates:
+        if report is not None and report != report_index:
+            continue
+        if (report_index, ordinal) != (current, day):
+            for line in close_day():
+                yield line
+            day_totals = {}
+        if report_index != current and totals:
+            for line in customer_summary(totals):
+                yield line
+            totals = {}
+        current, day = report_index, ordinal
+        total = timedelta(minutes=minutes)
+        day_totals[customer] = total
+        totals[customer] = totals.get(customer, timedelta(0)) + total
+    for line in close_day():
+        yield line
+    if totals:
+        for line in customer_summary(totals):
+            yield line
+
+
+def timeline_lines(timeline, customer=None):
+    """Text lines for a merged timeline and the combined customer totals"""
+    totals = {}
+    for user, work in timeline:
+        if customer is not None and work.customer != customer:
+            continue
+        if work.customer not in totals:
+            totals[work.customer] = work.duration
+        else:
+            totals[work.customer] += work.duration
+        yield '%s %s %s %s %s' % (
+            work.end.strftime('%Y-%m-%d %H:%M'), user,
+            format_timedelta(work.duration), work.customer, work.description)
+    yield '---------------------------------------------'
+    for line in customer_totals(totals, 'combined totals: '):
+        yield line
+
+
+def status_lines(filename, now):
+    """Text lines for the current status of a stamp file"""
+    now = now.replace(second=0, microsecond=0)
+    last, since, customers = current_status(filename, now)
+    lines = []
+    if last is not None:
+        lines.append('last stamp: %s (%s ago)' % (
+            last.strftime('%Y-%m-%d %H:%M'), format_timedelta(now - last)))
+    if since is not None:
+        lines.append('open since: %s (%s)' % (
+            since.strftime('%Y-%m-%d %H:%M'), format_timedelta(now - since)))
+    lines.append('---------- %s ----------' % now.date())
+    lines.extend(customer_totals(customers))
+    return lines
+
+
+def watch_status(filename, interval):
+    """Prints the status again when the file changes or a minute goes by"""
+    shown = None
+    while True:
+        now = datetime.now()
+        key = file_key(filename), now.replace(second=0, microsecond=0)
+        if key != shown:
+            print('\n'.join(status_lines(filename, now)) + '\n')
+            sys.stdout.flush()
+            shown = key
+        sleep(interval)
+
 
 ##############################################################################
 # Command line execution and argument parsing
 ##############################################################################
+# Arguments selecting a mode instead of the plain report. Only one is allowed
+MODES = ['now', 'check', 'group_by', 'merge', 'max_memory']
+# Optional arguments and the modes using them, None being the plain report
+OPTION_MODES = dict(
+    week=[None, 'max_memory'],
+    customer=[None, 'group_by', 'merge', 'max_memory'],
+    recover=[None],
+    workers=[None],
+    parallel_threshold=[None],
+    watch=['now'],
+    rollup_cache=['group_by'])
+
+
+def given(value):
+    """True for an argument given in the command line"""
+    return value is not None and value is not False
+
+
+def flag(dest):
+    """Command line spelling of an argument"""
+    return dest if dest == 'week' else '--' + dest.replace('_', '-')
+
+
+def command_mode(args):
+    """The mode argument given, None for the plain report"""
+    for mode in MODES:
+        if given(getattr(args, mode)):
+            return mode
+    return None
+
+
 def cmdline_arguments():
     """Parse the command line arguments via argparse"""
     parser = ArgumentParser(description='.workstampts.txt report tool')
@@ -375,19 +1344,174 @@ def cmdline_arguments():
     parser.add_argument(
         '--file', '-f', default=expanduser('~/.workstamps.txt'),
         help='Input filename (default: ~/.workstamps.txt)')
-    return parser.parse_args()
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument(
+        '--group-by', choices=sorted(BUCKETS),
+        help='Customer totals per calendar week, month or year')
+    parser.add_argument(
+        '--rollup-cache',
+        help='Cache file for --group-by (default: input filename + '
+             '.rollups)')
+    modes.add_argument(
+        '--max-memory', type=int, default=None,
+        help='Customer totals per day using at most about this many MB, '
+             'spilling to temporary files')
+    modes.add_argument(
+        '--merge', nargs='+', metavar='[USER=]FILE',
+        help='Timeline of several stamp files merged by time')
+    modes.add_argument(
+        '--now', action='store_true',
+        help="Time since the last stamp and today's customer totals")
+    parser.add_argument(
+        '--watch', type=float, metavar='SECONDS',
+        help='With --now, check the file for changes every SECONDS')
+    modes.add_argument(
+        '--check', action='store_true',
+        help='Only report the errors in the file')
+    parser.add_argument(
+        '--recover', action='store_true',
+        help='Skip malformed regions reporting them instead of stopping')
+    parser.add_argument(
+        '--workers', '-j', type=int, default=None,
+        help='Worker processes for parsing and rendering long reports '
+             '(default: one per CPU)')
+    parser.add_argument(
+        '--parallel-threshold', type=int, default=None,
+        help='Use the workers above this number of reports '
+             '(default: %d)' % PARALLEL_THRESHOLD)
+    args = parser.parse_args()
+    mode = command_mode(args)
+    for option in sorted(OPTION_MODES):
+        if not given(getattr(args, option)) or mode in OPTION_MODES[option]:
+            continue
+        if mode is None:
+            parser.error('argument %s: needs %s' % (flag(option), ' or '.join(
+                flag(needed) for needed in OPTION_MODES[option])))
+        parser.error('argument %s: not used with %s' % (
+            flag(option), flag(mode)))
+    return args
+
+
+def run_now(args):
+    """Prints the current status, once or until interrupted"""
+    try:
+        if not args.watch:
+            for line in status_lines(args.file, datetime.now()):
+                print(line)
+        else:
+            watch_status(args.file, args.watch)
+    except KeyboardInterrupt:
+        pass
+    except ParseError as error:
+        print('%s (--check gives its line number)' % error, file=sys.stderr)
+        return 1
+    return 0
+
+
+def run_check(args):
+    """Prints the errors in the file"""
+    errors = check_workstamps(args.file)
+    for error in errors:
+        print(error)
+    return 1 if errors else 0
+
+
+def run_group_by(args):
+    """Prints the customer totals per calendar bucket"""
+    cache = RollupCache(args.file, args.rollup_cache or args.file + '.rollups')
+    for line in rollup_lines(cache.rollups()[args.group_by], args.customer):
+        print(line)
+    return 0
+
+
+def run_merge(args):
+    """Prints the timeline of several stamp files"""
+    timeline = merged_timeline([timeline_source(f) for f in args.merge])
+    try:
+        for line in timeline_lines(timeline, args.customer):
+            print(line)
+    except ParseError as error:
+        print(error, file=sys.stderr)
+        return 1
+    return 0
+
+
+def run_max_memory(args):
+    """Prints the customer totals per day aggregated in bounded memory"""
+    context = aggregate_workstamps(
+        args.file, args.max_memory * 1024 * 1024, args.customer)
+    report = None
+    try:
+        if args.week is not None:
+            if not 0 <= args.week < context.reports:
+                print('week %d: the file has %d reports' % (
+                    args.week, context.reports), file=sys.stderr)
+                return 1
+            report = context.reports - 1 - args.week
+        for line in aggregate_lines(merged_aggregates(context), report):
+            print(line)
+    finally:
+        context.close()
+    return 0
+
+
+def worker_count(args):
+    """Worker processes asked for, one per CPU by default"""
+    if args.workers is not None:
+        return args.workers
+    # pylint: disable=import-outside-toplevel
+    from multiprocessing import cpu_count
+    return cpu_count()
+
+
+def run_report(args):
+    """Prints the plain report, by worker processes for long histories"""
+    errors = [] if args.recover else None
+    threshold = args.parallel_threshold
+    if threshold is None:
+        threshold = PARALLEL_THRESHOLD
+    if args.week is None and worker_count(args) > 1:
+        ranges = report_ranges(args.file)
+        if len(ranges) > threshold:
+            return run_parallel_report(args, ranges, errors)
+    reports = parse_workstamps(args.file, errors)
+    for error in errors or ():
+        print(error, file=sys.stderr)
+    TextReport(
+        stats_by_day(
+            filter_customer(
+                args.customer, filter_report(
+                    args.week, reports)))).write(sys.stdout)
+    return 0
+
+
+def run_parallel_report(args, ranges, errors):
+    """Prints the plain report of all weeks parsed and rendered by worker
+    processes, and then the errors skipped"""
+    for line in parallel_report_lines(
+            args.file, ranges, worker_count(args), args.customer, errors):
+        sys.stdout.write(line + '\n')
+    for error in errors or ():
+        print(error, file=sys.stderr)
+    return 0
+
+
+# What runs each mode
+MODE_RUNNERS = {
+    None: run_report,
+    'now': run_now,
+    'check': run_check,
+    'group_by': run_group_by,
+    'merge': run_merge,
+    'max_memory': run_max_memory,
+}
 
 
 def run_from_command_line():
     """Run the report with command line arguments"""
     args = cmdline_arguments()
-    print(TextReport(
-        stats_by_day(
-            filter_customer(
-                args.customer, filter_report(
-                    args.week, parse_workstamps(
-                        args.file))))).text)
+    return MODE_RUNNERS[command_mode(args)](args)
 
 
 if __name__ == '__main__':
-    run_from_command_line()
+    sys.exit(run_from_command_line())
@@ -1,33 +1,101 @@
 from datetime import datetime, timedelta, date
+from time import sleep
+import random
 import sys
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 from mock import mock_open, patch, Mock
 import pytest
 
+from bench import (
+    ENGINES,
+    differs,
+    random_stamps,
+    without_bad_regions,
+    write_case,
+    write_stamps)
 from days_calc import (
+    ParseError,
     Item,
+    Malformed,
     RestartTotals,
     Start,
     Work,
+    SymbolTable,
     itemify,
+    itemify_lines,
     item_factory,
     WorkItem,
     initial_state,
     expect_work,
     working,
+    skipping,
+    run_states,
     ParserContext,
+    PeriodContext,
+    CheckContext,
     parse_workstamps,
+    check_workstamps,
     filter_report,
     filter_customer,
     stats_by_day,
     WorkDay,
     WorkReport,
+    StampLog,
+    StampParse,
+    ReportStore,
+    week_bucket,
+    month_bucket,
+    year_bucket,
+    RollupContext,
+    RollupCache,
+    rollup_lines,
+    SpillingContext,
+    write_spill,
+    merged_aggregates,
+    aggregate_workstamps,
+    aggregate_lines,
+    StreamContext,
+    stream_work_items,
+    merged_timeline,
+    timeline_source,
+    timeline_lines,
+    reversed_lines,
+    day_tail,
+    current_status,
+    status_lines,
+    watch_status,
     format_timedelta,
     customer_totals,
     customer_summary,
     day_report,
+    report_lines,
+    report_ranges,
+    joined_ranges,
+    parallel_report_lines,
     TextReport,
-    cmdline_arguments)
+    MODE_RUNNERS,
+    command_mode,
+    cmdline_arguments,
+    run_from_command_line)
+
+
+class TestParseError(object):
+    def test_is_runtime_error(self):
+        assert isinstance(ParseError('boom', 3), RuntimeError)
+
+    def test_str(self):
+        assert 'line 4: boom' == str(ParseError('boom', 3))
+
+    def test_str_source(self):
+        assert 'a.txt: line 4: boom' == str(ParseError('boom', 3, 'a.txt'))
+
+    def test_str_unknown_line(self):
+        assert 'boom' == str(ParseError('boom', None))
 
 
 @pytest.mark.parametrize(('attr', 'value'), [
@@ -40,6 +108,12 @@ def test_item(attr, value):
     assert value == getattr(sut, attr)
 
 
+def test_malformed():
+    sut = Malformed(24)
+    assert sut.is_malformed
+    assert 'line 24: malformed' == repr(sut)
+
+
 class TestItem(object):
     @pytest.fixture
     def sut(self):
@@ -117,6 +191,19 @@ class TestWork(object):
         assert expected == (sut == other)
 
 
+class TestSymbolTable(object):
+    def test_intern_shares(self):
+        sut = SymbolTable()
+        first = sut.intern(''.join(['cu', 'st']))
+        assert first is sut.intern(''.join(['cus', 't']))
+
+    def test_len(self):
+        sut = SymbolTable()
+        for text in ['a', 'b', 'a']:
+            sut.intern(text)
+        assert 2 == len(sut)
+
+
 class TestItemify(object):
     def test_iter(self):
         m = mock_open()
@@ -131,6 +218,26 @@ class TestItemify(object):
             result = list(itemify('filename'))
         popen.assert_called_with('filename', 'r')
 
+    def test_error_raises(self, tmpdir):
+        stamps = tmpdir.join('stamps')
+        stamps.write('2001-02-03 1x:34 start\n')
+        with pytest.raises(ParseError):
+            list(itemify(str(stamps)))
+
+    def test_error_skipped(self, tmpdir):
+        stamps = tmpdir.join('stamps')
+        stamps.write('2001-02-03 1x:34 start\n2001-02-03 15:34 start\n')
+        errors = []
+        result = list(itemify(str(stamps), errors))
+        assert [Malformed(0), Start(1, '2001-02-03 15:34')] == result
+        assert [0] == [error.lineno for error in errors]
+
+
+def test_itemify_lines():
+    lines = [(3, '\n'), (4, '2001-02-03 15:34 start\n')]
+    assert [Start(4, '2001-02-03 15:34')] == list(
+        itemify_lines(lines, SymbolTable()))
+
 
 class TestItemFactory(object):
     def test_restart(self):
@@ -145,6 +252,24 @@ class TestItemFactory(object):
         expected = Work(12, '2001-02-03 15:34', 'customer', 'my descrip tion')
         assert expected == res
 
+    @pytest.mark.parametrize('line', [
+        '2001-02-03 15:34',
+        '2001-02-03 15:34 ',
+        '2001-02-xx 15:34 start',
+        '2001-02-30 15:34 cust desc',
+        'restarttotal'])
+    def test_malformed(self, line):
+        with pytest.raises(ParseError) as error:
+            item_factory(12, line)
+        assert 12 == error.value.lineno
+
+    def test_work_symbols(self):
+        symbols = SymbolTable()
+        one = item_factory(1, '2001-02-03 15:34 cust d', symbols)
+        two = item_factory(2, '2001-02-03 15:35 cust d', symbols)
+        assert one.customer is two.customer
+        assert one.description is two.description
+
 
 @pytest.fixture
 def work_line():
@@ -247,6 +372,100 @@ class TestWorking(object):
             working('context', Item(12))
 
 
+class TestSkipping(object):
+    def test_work_skipped(self, work_line):
+        assert skipping is skipping(Mock(), work_line)
+
+    def test_start_resumes(self, start_line):
+        context = Mock()
+        assert expect_work is skipping(context, start_line)
+        assert start_line.when == context.start_period
+
+    def test_restart_resumes(self, restart_line):
+        context = Mock()
+        assert initial_state is skipping(context, restart_line)
+        context.add_current_report.assert_called_with()
+
+
+class TestRunStates(object):
+    @pytest.fixture
+    def items(self, start_line, work_line):
+        return [work_line, work_line, start_line, start_line, work_line]
+
+    def test_raises(self, items):
+        with pytest.raises(ParseError):
+            run_states(ParserContext(), items)
+
+    def test_recovers(self, items, start_line, work_line):
+        context = ParserContext()
+        errors = []
+        assert working is run_states(context, items, errors)
+        context.add_current_report()
+        assert [[WorkItem(start_line.when, work_line)]] == context.reports
+        assert [12, 11] == [error.lineno for error in errors]
+
+    def test_malformed_breaks_period(self, start_line, work_line):
+        context = ParserContext()
+        items = [start_line, work_line, Malformed(13),
+                 Work(14, '2001-01-03 05:15', 'cst', 'dsc')]
+        assert skipping is run_states(context, items, [])
+        context.add_current_report()
+        assert [[WorkItem(start_line.when, work_line)]] == context.reports
+
+
+def test_recover_bad_work_line(tmpdir):
+    stamps = tmpdir.join('stamps')
+    stamps.write('\n'.join([
+        '2001-01-01 09:00 start',
+        '2001-01-01 10:00 cust1',
+        '2001-01-01 1x:00 cust2 bad',
+        '2001-01-01 12:00 cust3',
+        '2001-01-01 13:00 start',
+        '2001-01-01 14:00 cust3']))
+    errors = []
+    reports = stats_by_day(parse_workstamps(str(stamps), errors))
+    expected = {'cust1': timedelta(0, 3600), 'cust3': timedelta(0, 3600)}
+    assert expected == reports[0].customers
+    assert [2] == [error.lineno for error in errors]
+
+
+class TestPeriodContext(object):
+    class Recording(PeriodContext):
+        def __init__(self):
+            super(TestPeriodContext.Recording, self).__init__()
+            self.calls = []
+
+        def add_work(self, item):
+            self.calls.append(('work', item.start, item.end))
+
+        def close_report(self):
+            self.calls.append(('close', self.start_period))
+
+    def test_hooks(self, work_line):
+        sut = self.Recording()
+        sut.start_period = datetime(2001, 1, 3, 4)
+        sut.add_item(work_line)
+        sut.add_current_report()
+        expected = [
+            ('work', datetime(2001, 1, 3, 4), work_line.when),
+            ('close', work_line.when)]
+        assert expected == sut.calls
+        assert sut.start_period is None
+
+
+class TestCheckContext(object):
+    def test_add_item(self, work_line):
+        sut = CheckContext()
+        sut.add_item(work_line)
+        assert work_line.when == sut.start_period
+
+    def test_add_current_report(self, work_line):
+        sut = CheckContext()
+        sut.add_item(work_line)
+        sut.add_current_report()
+        assert sut.start_period is None
+
+
 class TestParserContext(object):
     @pytest.fixture
     def sut(self):
@@ -269,12 +488,27 @@ class TestParserContext(object):
         sut.add_current_report()
         assert [] == sut.reports
 
+    def test_current(self, sut, work_line):
+        sut.add_item(work_line)
+        assert [WorkItem(None, work_line)] == sut.current
+
     def test_add_current_report_start(self, sut, work_line):
         sut.start_period = 'banana'
         sut.add_item(work_line)
         sut.add_current_report()
         assert sut.start_period is None
 
+    def test_copy(self, sut, work_line):
+        sut.add_item(work_line)
+        sut.add_current_report()
+        sut.add_item(work_line)
+        other = sut.copy()
+        other.add_current_report()
+        assert [[WorkItem(None, work_line)]] == sut.reports
+        assert [WorkItem(None, work_line)] == sut.current
+        assert work_line.when == sut.start_period
+        assert sut.reports + [sut.current] == other.reports
+
 
 @pytest.fixture
 def work_items():
@@ -302,13 +536,36 @@ class TestParseWorkstamps(object):
 
     def test_build_itemify(self):
         res, pitemify = self.call_sut([])
-        pitemify.assert_called_with('filename')
+        pitemify.assert_called_with('filename', None)
 
     def test_parse(self, items, work_items):
         res = self.call_sut(items)[0]
         expected = [[work_items[0]], [work_items[1]]]
         assert expected == res
 
+    def test_parse_errors(self, items, work_items):
+        errors = []
+        with patch('days_calc.itemify') as pitemify:
+            pitemify.return_value = [items[1]] + items
+            res = parse_workstamps('filename', errors)
+        pitemify.assert_called_with('filename', errors)
+        assert [[work_items[0]], [work_items[1]]] == res
+        assert [13] == [error.lineno for error in errors]
+
+
+def test_check_workstamps(tmpdir):
+    stamps = tmpdir.join('stamps')
+    stamps.write('\n'.join([
+        '2001-01-01 09:00 cust early',
+        '2001-01-01 10:00 start',
+        '2001-01-01 11:00 start',
+        '2001-01-01 12:00 cust desc',
+        '2001-01-01 1x:00 cust desc',
+        'restarttotals',
+        'restarttotals']))
+    errors = check_workstamps(str(stamps))
+    assert [0, 2, 4, 6] == [error.lineno for error in errors]
+
 
 class TestFilterReport(object):
     def test_none(self):
@@ -374,6 +631,571 @@ class TestWorkReport(object):
         assert {'mycust': timedelta(0, 14400)} == work_report.customers
 
 
+class TestStampLog(object):
+    @pytest.fixture
+    def stamps(self, tmpdir):
+        stamps = tmpdir.join('stamps')
+        stamps.write('restarttotals\n\nrestarttotals')
+        return stamps
+
+    def test_lines(self, stamps):
+        sut = StampLog(str(stamps))
+        assert [(0, 'restarttotals\n'), (1, '\n')] == list(sut.lines())
+        assert (15, 2) == (sut.offset, sut.lineno)
+        assert (2, 'restarttotals') == sut.pending
+
+    def test_pending_read_again(self, stamps):
+        sut = StampLog(str(stamps))
+        list(sut.lines())
+        stamps.write('\n', mode='a')
+        assert [(2, 'restarttotals\n')] == list(sut.lines())
+        assert sut.pending is None
+
+    def test_appended(self, stamps):
+        sut = StampLog(str(stamps))
+        list(sut.lines())
+        stamps.write('\nrestarttotals\n', mode='a')
+        assert sut.is_continuation()
+        assert [(2, 'restarttotals\n'), (3, 'restarttotals\n')] == list(
+            sut.lines())
+
+    def test_rewritten(self, stamps):
+        sut = StampLog(str(stamps))
+        list(sut.lines())
+        stamps.write('2001-01-01 00:00 start\n')
+        assert not sut.is_continuation()
+
+    def test_replaced(self, stamps, tmpdir):
+        sut = StampLog(str(stamps))
+        list(sut.lines())
+        other = tmpdir.join('other')
+        other.write(stamps.read() + 'restarttotals\n')
+        other.move(stamps)
+        assert not sut.is_continuation()
+
+
+class TestStampParse(object):
+    def test_advance(self, tmpdir):
+        stamps = tmpdir.join('stamps')
+        stamps.write('2001-01-01 09:00 start\n2001-01-01 10:00 cust1')
+        sut = StampParse(str(stamps))
+        context = sut.advance()
+        assert [] == sut.context.current
+        assert expect_work == sut.state
+        assert 1 == len(context.current)
+        stamps.write(' one\nrestarttotals\n', mode='a')
+        assert sut.advance() is sut.context
+        assert initial_state == sut.state
+        assert 1 == len(sut.context.reports)
+
+
+class TestReportStore(object):
+    lines = [
+        '2001-01-01 09:00 start',
+        '2001-01-01 10:00 cust1 one',
+        '2001-01-02 09:00 start',
+        '2001-01-02 11:00 cust2 two',
+        'restarttotals',
+        '2001-01-03 09:00 start',
+        '2001-01-03 09:30 cust1 three']
+
+    @pytest.fixture
+    def stamps(self, tmpdir):
+        stamps = tmpdir.join('stamps')
+        stamps.write('\n'.join(self.lines) + '\n')
+        return stamps
+
+    @pytest.fixture
+    def sut(self, stamps):
+        return ReportStore(str(stamps))
+
+    def test_reports(self, sut, stamps):
+        expected = stats_by_day(parse_workstamps(str(stamps)))
+        assert expected == sut.reports()
+        assert [r.customers for r in expected] == [
+            r.customers for r in sut.reports()]
+
+    def test_cached(self, sut):
+        assert sut.reports() is sut.reports()
+
+    def test_appended(self, sut, stamps):
+        first = sut.report(1)
+        stamps.write('2001-01-03 10:00 cust2 four\n', mode='a')
+        with patch('days_calc.file_key') as pkey:
+            pkey.return_value = 'changed'
+            assert first is sut.report(1)
+        assert stats_by_day(parse_workstamps(str(stamps))) == sut.reports()
+        assert {'cust1': timedelta(0, 1800), 'cust2': timedelta(0, 1800)} \
+            == sut.report(0).customers
+
+    def test_rewritten(self, sut, stamps):
+        sut.reports()
+        stamps.write('\n'.join(self.lines[:2]) + '\n')
+        with patch('days_calc.file_key') as pkey:
+            pkey.return_value = 'changed'
+            assert 1 == len(sut.reports())
+
+    def test_no_final_newline(self, sut, stamps):
+        stamps.write('\n'.join(self.lines))
+        expected = stats_by_day(parse_workstamps(str(stamps)))
+        assert expected == sut.reports()
+        assert ['cust1'] == list(sut.report(0).customers)
+        stamps.write('\n2001-01-03 10:00 cust2 five\n', mode='a')
+        with patch('days_calc.file_key') as pkey:
+            pkey.return_value = 'changed'
+            assert stats_by_day(parse_workstamps(str(stamps))) == \
+                sut.reports()
+
+    def test_no_final_newline_restart(self, sut, stamps):
+        stamps.write('\n'.join(self.lines) + '\nrestarttotals')
+        assert stats_by_day(parse_workstamps(str(stamps))) == sut.reports()
+
+    def test_error_resets(self, sut, stamps):
+        stamps.write('2001-01-01 10:00 cust1 one\n')
+        with pytest.raises(ParseError):
+            sut.reports()
+        stamps.write('\n'.join(self.lines) + '\n')
+        with patch('days_calc.file_key') as pkey:
+            pkey.return_value = 'changed'
+            assert 2 == len(sut.reports())
+
+    def test_customers(self, sut):
+        assert ['cust1', 'cust2'] == sut.customers()
+
+    def test_days(self, sut):
+        days = sut.days(date(2001, 1, 2), date(2001, 1, 3))
+        assert [date(2001, 1, 2), date(2001, 1, 3)] == [d.date for d in days]
+        assert sut.reports()[0][1] is days[0]
+
+    def test_totals(self, sut):
+        expected = {'cust1': timedelta(0, 5400), 'cust2': timedelta(0, 7200)}
+        assert expected == sut.totals()
+
+    def test_totals_range(self, sut):
+        expected = {'cust1': timedelta(0, 1800)}
+        assert expected == sut.totals(start=date(2001, 1, 3))
+
+
+@pytest.mark.parametrize(('bucket', 'expected'), [
+    (week_bucket, '2013-W01'),
+    (month_bucket, '2012-12'),
+    (year_bucket, '2012')])
+def test_buckets(bucket, expected):
+    assert expected == bucket(date(2012, 12, 31))
+
+
+class TestRollupContext(object):
+    def test_add_item(self, work_line):
+        sut = RollupContext()
+        sut.start_period = datetime(2001, 1, 3, 3, 0)
+        sut.add_item(work_line)
+        sut.add_item(work_line)
+        assert {'2001-01': {'cst': 75}} == sut.rollups['month']
+        assert {'2001-W01': {'cst': 75}} == sut.rollups['week']
+        assert {'2001': {'cst': 75}} == sut.rollups['year']
+        assert work_line.when == sut.start_period
+
+    def test_add_current_report(self, work_line):
+        sut = RollupContext()
+        sut.start_period = datetime(2001, 1, 3, 3, 0)
+        sut.add_item(work_line)
+        sut.add_current_report()
+        assert sut.start_period is None
+
+
+class TestRollupCache(object):
+    lines = [
+        '2001-01-31 23:00 start',
+        '2001-02-01 01:00 cust1 midnight',
+        'restarttotals',
+        '2001-02-02 09:00 start',
+        '2001-02-02 09:30 cust2']
+
+    @pytest.fixture
+    def stamps(self, tmpdir):
+        stamps = tmpdir.join('stamps')
+        stamps.write('\n'.join(self.lines) + '\n')
+        return stamps
+
+    @pytest.fixture
+    def sut(self, stamps, tmpdir):
+        return RollupCache(str(stamps), str(tmpdir.join('cache')))
+
+    def test_rollups(self, sut):
+        expected = {'2001-02': {'cust1': 120, 'cust2': 30}}
+        assert expected == sut.rollups()['month']
+
+    def test_cached(self, sut):
+        sut.rollups()
+        with patch('days_calc.StampLog') as plog:
+            assert {'2001': {'cust1': 120, 'cust2': 30}} == \
+                sut.rollups()['year']
+        assert not plog.called
+
+    def test_appended(self, sut, stamps):
+        sut.rollups()
+        stamps.write('2001-03-01 00:15 cust2\n', mode='a')
+        with patch('days_calc.file_key') as pkey:
+            pkey.return_value = ('changed',)
+            with patch('days_calc.WorkItem', wraps=WorkItem) as pitem:
+                res = sut.rollups()['month']
+        assert 1 == pitem.call_count
+        expected = {
+            '2001-02': {'cust1': 120, 'cust2': 30},
+            '2001-03': {'cust2': 27 * 24 * 60 - 9 * 60 - 15}}
+        assert expected == res
+
+    def test_rewritten(self, sut, stamps):
+        sut.rollups()
+        stamps.write('\n'.join(self.lines[:2]) + '\n')
+        with patch('days_calc.file_key') as pkey:
+            pkey.return_value = ('changed',)
+            assert {'2001': {'cust1': 120}} == sut.rollups()['year']
+
+    def test_no_final_newline(self, sut, stamps):
+        stamps.write('\n'.join(self.lines))
+        expected = {'2001': {'cust1': 120, 'cust2': 30}}
+        assert expected == sut.rollups()['year']
+        assert expected == sut.rollups()['year']
+        stamps.write('\n2001-02-02 10:00 cust1\n', mode='a')
+        with patch('days_calc.file_key') as pkey:
+            pkey.return_value = ('changed',)
+            assert {'2001': {'cust1': 150, 'cust2': 30}} == \
+                sut.rollups()['year']
+
+    def test_other_file(self, sut, stamps, tmpdir):
+        sut.rollups()
+        other = tmpdir.join('other')
+        other.write('\n'.join(self.lines[:2]) + '\n')
+        res = RollupCache(str(other), sut.cache_filename).rollups()
+        assert {'2001': {'cust1': 120}} == res['year']
+
+
+def test_rollup_lines():
+    buckets = {
+        '2001-02': {'cust1': 120, 'cust2': 30},
+        '2001-01': {'cust2': 61}}
+    expected = [
+        '---------- 2001-01 ----------', 'cust2: 1:01',
+        '---------- 2001-02 ----------', 'cust2: 0:30']
+    assert expected == rollup_lines(buckets, 'cust2')
+
+
+class TestSpillingContext(object):
+    @pytest.fixture
+    def sut(self):
+        sut = SpillingContext(1024 * 1024)
+        sut.start_period = datetime(2001, 1, 3, 3, 0)
+        return sut
+
+    def test_add_item(self, sut, work_line):
+        sut.add_item(work_line)
+        sut.add_item(work_line)
+        day = date(2001, 1, 3).toordinal()
+        assert {(0, day, 'cst'): 75} == sut.aggregates
+        assert work_line.when == sut.start_period
+
+    def test_customer(self, sut, work_line):
+        sut.customer = 'other'
+        sut.add_item(work_line)
+        assert {} == sut.aggregates
+        assert work_line.when == sut.start_period
+
+    def test_reports(self, sut, work_line):
+        sut.add_current_report()
+        assert 0 == sut.reports
+        sut.start_period = datetime(2001, 1, 3, 3, 0)
+        sut.add_item(work_line)
+        sut.add_current_report()
+        assert 1 == sut.reports
+        assert sut.start_period is None
+
+    def test_spill(self, sut, work_line):
+        sut.max_aggregates = 1
+        sut.add_item(work_line)
+        day = date(2001, 1, 3).toordinal()
+        assert {} == sut.aggregates
+        assert '0\t%d\t75\tcst\n' % day == sut.spills[0][1].read()
+        sut.close()
+        assert [] == sut.spills
+
+    def test_merge_rows_written(self, sut):
+        written = []
+
+        def counting_spill(aggregates):
+            aggregates = list(aggregates)
+            written.append(len(aggregates))
+            return write_spill(aggregates)
+
+        sut.max_aggregates = 1
+        sut.start_period = datetime(2000, 12, 31)
+        with patch('days_calc.MERGE_WIDTH', 2), \
+                patch('days_calc.write_spill', counting_spill):
+            for day in range(64):
+                when = datetime(2001, 1, 1) + timedelta(day)
+                sut.add_item(Work(day, when.strftime('%Y-%m-%d %H:%M'), 'c'))
+        # Each of the 64 rows is written once per level: 1 + log2(64)
+        assert 64 * 7 == sum(written)
+        assert [(6, sut.spills[0][1])] == sut.spills
+        sut.close()
+
+    def test_merge_spills(self, sut, work_line):
+        sut.max_aggregates = 1
+        with patch('days_calc.MERGE_WIDTH', 2):
+            sut.add_item(work_line)
+            sut.add_item(work_line)
+        day = date(2001, 1, 3).toordinal()
+        assert 1 == len(sut.spills)
+        assert '0\t%d\t75\tcst\n' % day == sut.spills[0][1].read()
+
+
+@pytest.fixture
+def spilled_stamps(tmpdir):
+    stamps = tmpdir.join('stamps')
+    stamps.write('\n'.join([
+        '2001-01-01 09:00 start',
+        '2001-01-01 10:00 cust1 one',
+        '2001-01-01 10:30 cust2 two',
+        '2001-01-01 11:00 cust1 three',
+        'restarttotals',
+        '2001-01-02 09:00 start',
+        '2001-01-02 09:15 cust2 four']))
+    return str(stamps)
+
+
+def test_merged_aggregates(spilled_stamps):
+    context = aggregate_workstamps(spilled_stamps, 2 * 256)
+    assert 2 == len(context.spills)
+    first, second = date(2001, 1, 1).toordinal(), date(2001, 1, 2).toordinal()
+    expected = [
+        (0, first, 'cust1', 90), (0, first, 'cust2', 30),
+        (1, second, 'cust2', 15)]
+    assert expected == list(merged_aggregates(context))
+    assert 2 == context.reports
+    context.close()
+
+
+class TestAggregateLines(object):
+    aggregates = [
+        (0, date(2001, 1, 1).toordinal(), 'cust1', 90),
+        (0, date(2001, 1, 1).toordinal(), 'cust2', 30),
+        (0, date(2001, 1, 2).toordinal(), 'cust2', 30),
+        (1, date(2001, 1, 3).toordinal(), 'cust2', 15)]
+
+    def test_lines(self):
+        expected = [
+            '---------- 2001-01-01 ----------', 'cust1: 1:30', 'cust2: 0:30',
+            '---------- 2001-01-02 ----------', 'cust2: 0:30',
+            '---------------------------------------------',
+            'restart totals: cust1: 1:30', 'restart totals: cust2: 1:00', '',
+            '---------- 2001-01-03 ----------', 'cust2: 0:15',
+            '---------------------------------------------',
+            'restart totals: cust2: 0:15', '']
+        assert expected == list(aggregate_lines(self.aggregates))
+
+    def test_report(self):
+        expected = [
+            '---------- 2001-01-03 ----------', 'cust2: 0:15',
+            '---------------------------------------------',
+            'restart totals: cust2: 0:15', '']
+        assert expected == list(aggregate_lines(self.aggregates, 1))
+
+    def test_empty(self):
+        assert [] == list(aggregate_lines([]))
+
+
+class TestStreamContext(object):
+    def test_add_item(self, work_line):
+        sut = StreamContext()
+        sut.start_period = datetime(2001, 1, 3, 3, 0)
+        sut.add_item(work_line)
+        assert [WorkItem(datetime(2001, 1, 3, 3), work_line)] == sut.parsed
+        assert work_line.when == sut.start_period
+
+    def test_add_current_report(self):
+        sut = StreamContext()
+        sut.start_period = 'banana'
+        sut.add_current_report()
+        assert sut.start_period is None
+
+
+@pytest.fixture
+def timeline_files(tmpdir):
+    first = tmpdir.join('alice')
+    first.write('\n'.join([
+        '2001-01-01 09:00 start',
+        '2001-01-01 10:00 cust1 one',
+        'restarttotals',
+        '2001-01-01 23:00 start',
+        '2001-01-02 01:00 cust2 two']))
+    second = tmpdir.join('bob')
+    second.write('\n'.join([
+        '2001-01-01 08:00 start',
+        '2001-01-01 09:30 cust1 three',
+        '2001-01-01 10:00 cust2 four']))
+    return str(first), str(second)
+
+
+def test_stream_work_items(timeline_files):
+    assert [item for group in parse_workstamps(timeline_files[0])
+            for item in group] == list(stream_work_items(timeline_files[0]))
+
+
+class TestMergedTimeline(object):
+    def test_order(self, timeline_files):
+        sources = [('a', timeline_files[0]), ('b', timeline_files[1])]
+        res = [(user, item.description)
+               for user, item in merged_timeline(sources)]
+        expected = [('b', 'three'), ('a', 'one'), ('b', 'four'), ('a', 'two')]
+        assert expected == res
+
+    def test_streams(self):
+        def endless(filename):
+            start = datetime(2001, 1, 1)
+            step = timedelta(0, 60 if filename == 'a' else 120)
+            while True:
+                end = start + step
+                yield WorkItem(
+                    start, Work(0, end.strftime('%Y-%m-%d %H:%M'), filename))
+                start = end
+
+        with patch('days_calc.stream_work_items', endless):
+            timeline = merged_timeline([('a', 'a'), ('b', 'b')])
+            res = [next(timeline)[0] for _ in range(4)]
+        assert ['a', 'a', 'b', 'a'] == res
+
+    def test_error_source(self, timeline_files, tmpdir):
+        broken = tmpdir.join('broken')
+        broken.write('2001-01-01 09:00 cust1 no start\n')
+        sources = [('a', timeline_files[0]), ('b', str(broken))]
+        with pytest.raises(ParseError) as error:
+            list(merged_timeline(sources))
+        assert 'b (%s)' % broken == error.value.source
+        assert str(error.value).startswith('b (%s): line 1: ' % broken)
+
+
+@pytest.mark.parametrize(('argument', 'expected'), [
+    ('/home/alice.txt', ('alice.txt', '/home/alice.txt')),
+    ('bob=/home/b.txt', ('bob', '/home/b.txt')),
+    ('/tmp/a=b.txt', ('a=b.txt', '/tmp/a=b.txt')),
+    ('./a=b.txt', ('a=b.txt', './a=b.txt'))])
+def test_timeline_source(argument, expected):
+    assert expected == timeline_source(argument)
+
+
+class TestTimelineLines(object):
+    @pytest.fixture
+    def timeline(self, work_items):
+        return [('alice', work_items[0]), ('bob', work_items[1])]
+
+    def test_lines(self, timeline):
+        expected = [
+            '2001-01-01 01:00 alice 1:00 mycust mydesc',
+            '2001-01-02 01:00 bob 1:00 mycust mydesc',
+            '---------------------------------------------',
+            'combined totals: mycust: 2:00']
+        assert expected == list(timeline_lines(timeline))
+
+    def test_customer(self, timeline):
+        expected = [
+            '---------------------------------------------']
+        assert expected == list(timeline_lines(timeline, 'other'))
+
+
+@pytest.mark.parametrize('block', [1, 3, 4096])
+def test_reversed_lines(tmpdir, block):
+    stamps = tmpdir.join('stamps')
+    stamps.write('one\ntwo\n\nthree\n')
+    expected = ['', 'three', '', 'two', 'one']
+    assert expected == list(reversed_lines(str(stamps), block))
+
+
+class TestCurrentStatus(object):
+    lines = [
+        '2001-01-01 09:00 start',
+        '2001-01-01 10:00 cust1 old',
+        '2001-01-01 23:00 cust1 before midnight',
+        '2001-01-02 01:00 cust2 after midnight',
+        'restarttotals',
+        '2001-01-02 09:00 start',
+        '2001-01-02 09:45 cust1 today']
+
+    @pytest.fixture
+    def stamps(self, tmpdir):
+        stamps = tmpdir.join('stamps')
+        stamps.write('\n'.join(self.lines) + '\n\n')
+        return stamps
+
+    def test_day_tail(self, stamps):
+        assert self.lines[2:] == day_tail(str(stamps), date(2001, 1, 2))
+
+    def test_day_tail_no_stamps_today(self, stamps):
+        assert self.lines[-1:] == day_tail(str(stamps), date(2001, 1, 3))
+
+    def test_day_tail_whole_file(self, stamps):
+        assert self.lines == day_tail(str(stamps), date(2001, 1, 1))
+
+    def test_reads_tail_only(self, stamps):
+        stamps.write('garbage\n' + stamps.read())
+        with patch('days_calc.TAIL_BLOCK', 16):
+            res = current_status(str(stamps), datetime(2001, 1, 2, 10, 30))
+        assert datetime(2001, 1, 2, 9, 45) == res[0]
+
+    def test_status(self, stamps):
+        res = current_status(str(stamps), datetime(2001, 1, 2, 10, 30))
+        expected = (
+            datetime(2001, 1, 2, 9, 45), datetime(2001, 1, 2, 9, 45),
+            {'cust1': timedelta(0, 2700), 'cust2': timedelta(0, 7200)})
+        assert expected == res
+
+    def test_matches_full_parse(self, stamps):
+        days = [day for report in stats_by_day(parse_workstamps(str(stamps)))
+                for day in report if day.date == date(2001, 1, 2)]
+        res = current_status(str(stamps), datetime(2001, 1, 2, 10, 30))
+        assert WorkReport(days).customers == res[2]
+
+    def test_malformed_today(self, stamps):
+        stamps.write('\n2001-01-02 1x:00 cust1 bad\n', mode='a')
+        with pytest.raises(ParseError) as error:
+            current_status(str(stamps), datetime(2001, 1, 2, 10, 30))
+        assert error.value.lineno is None
+        assert "'2001-01-02 1x:00 cust1 bad'" in str(error.value)
+
+    def test_now_malformed_today(self, stamps, capsys):
+        stamps.write('2001-01-02 1x:00 cust1 bad\n', mode='a')
+        argv = ['basename', '--now', '-f', str(stamps)]
+        with patch.object(sys, 'argv', argv):
+            assert 1 == run_from_command_line()
+        expected = (
+            "malformed date and time '2001-01-02 1x:00' at "
+            "'2001-01-02 1x:00 cust1 bad' (--check gives its line number)\n")
+        assert expected == capsys.readouterr().err
+
+    def test_restart(self, stamps):
+        stamps.write('restarttotals\n', mode='a')
+        res = current_status(str(stamps), datetime(2001, 1, 3, 10, 30))
+        assert (datetime(2001, 1, 2, 9, 45), None, {}) == res
+
+    def test_lines(self, stamps):
+        expected = [
+            'last stamp: 2001-01-02 09:45 (0:45 ago)',
+            'open since: 2001-01-02 09:45 (0:45)',
+            '---------- 2001-01-02 ----------',
+            'cust1: 0:45',
+            'cust2: 2:00']
+        res = status_lines(str(stamps), datetime(2001, 1, 2, 10, 30, 15))
+        assert expected == res[:3] + sorted(res[3:])
+
+    def test_watch(self, stamps):
+        with patch('days_calc.sleep') as psleep, \
+                patch('days_calc.print', create=True) as pprint:
+            psleep.side_effect = [None, KeyboardInterrupt]
+            with pytest.raises(KeyboardInterrupt):
+                watch_status(str(stamps), 5)
+        psleep.assert_called_with(5)
+        assert 1 == pprint.call_count
+
+
 class TestFormatTimestamp(object):
     def test_format(self):
         assert '240:05' == format_timedelta(timedelta(10, 300))
@@ -411,6 +1233,88 @@ def test_day_report(work_day):
     assert res == expected
 
 
+def test_report_lines(work_report):
+    res = report_lines(work_report)
+    expected = day_report(work_report[0]) * 2 + customer_summary(
+        work_report.customers)
+    assert expected == res
+
+
+def test_report_ranges(tmpdir):
+    stamps = tmpdir.join('stamps')
+    stamps.write('a\n restarttotals \n\nbb\nrestarttotals\nc')
+    expected = [(0, 18, 0), (18, 18, 2), (36, 1, 5)]
+    assert expected == report_ranges(str(stamps))
+
+
+def test_report_ranges_ends_at_restart(tmpdir):
+    stamps = tmpdir.join('stamps')
+    stamps.write('a\nrestarttotals\n')
+    assert [(0, 16, 0)] == report_ranges(str(stamps))
+
+
+def test_joined_ranges():
+    ranges = [(0, 3, 0), (3, 4, 2), (7, 5, 3)]
+    expected = [(0, 7, 0), (7, 5, 3)]
+    assert expected == list(joined_ranges(ranges, 2))
+
+
+class TestParallelReportLines(object):
+    @pytest.fixture
+    def stamps(self, tmpdir):
+        stamps = str(tmpdir.join('stamps'))
+        write_stamps(stamps, random_stamps(random.Random(1), days=300))
+        return stamps
+
+    @pytest.mark.parametrize('customer', [None, 'acme'])
+    def test_matches_sequential(self, stamps, customer):
+        expected = TextReport(stats_by_day(filter_customer(
+            customer, parse_workstamps(stamps)))).lines
+        with patch('days_calc.PARALLEL_CHUNKSIZE', 3):
+            lines = list(parallel_report_lines(
+                stamps, report_ranges(stamps), 2, customer))
+        assert expected == lines
+
+    def test_recover(self, tmpdir):
+        stamps = str(tmpdir.join('stamps'))
+        lines = random_stamps(random.Random(1), days=300, invalid=0.05)
+        write_stamps(stamps, lines, final_newline=False)
+        expected_errors = []
+        expected = TextReport(stats_by_day(parse_workstamps(
+            stamps, expected_errors))).lines
+        errors = []
+        with patch('days_calc.PARALLEL_CHUNKSIZE', 3):
+            lines = list(parallel_report_lines(
+                stamps, report_ranges(stamps), 2, errors=errors))
+        assert expected == lines
+        assert [str(e) for e in expected_errors] == [str(e) for e in errors]
+
+    def test_error(self, stamps):
+        with open(stamps, 'a') as outfile:
+            outfile.write('restarttotals\n2001-01-01 1x:00 acme\n')
+        with pytest.raises(ParseError) as expected:
+            parse_workstamps(stamps)
+        with pytest.raises(ParseError) as error:
+            list(parallel_report_lines(stamps, report_ranges(stamps), 2))
+        assert str(expected.value) == str(error.value)
+
+    def test_bounded(self, stamps):
+        handed_out = []
+
+        def ranges(ranges, _):
+            for part in ranges:
+                handed_out.append(part)
+                yield part
+
+        with patch('days_calc.joined_ranges', ranges):
+            lines = parallel_report_lines(stamps, report_ranges(stamps), 2)
+            next(lines)
+            sleep(0.2)
+            lines.close()
+        # 2 workers x 2 slots, the one written and the one waiting
+        assert len(handed_out) <= 6
+
+
 class TestTextReport(object):
     @pytest.fixture
     def sut(self, work_report):
@@ -441,8 +1345,83 @@ restart totals: mycust: 4:00
 """
         assert text == sut.text
 
+    def test_write(self, sut):
+        out = StringIO()
+        sut.write(out)
+        assert sut.text + '\n' == out.getvalue()
+
+
+class TestRunMaxMemory(object):
+    @pytest.fixture
+    def stamps(self, tmpdir):
+        stamps = tmpdir.join('stamps')
+        stamps.write(
+            '2001-01-01 09:00 start\n2001-01-01 10:00 cust1 one\n'
+            'restarttotals\n'
+            '2001-01-02 09:00 start\n2001-01-02 11:00 cust2 two\n')
+        return str(stamps)
+
+    def run_sut(self, stamps, week):
+        argv = ['basename', '--max-memory', '1', '-f', stamps, week]
+        with patch.object(sys, 'argv', argv):
+            return run_from_command_line()
+
+    @pytest.mark.parametrize('week,customer', [('0', 'cust2'), ('1', 'cust1')])
+    def test_week(self, stamps, week, customer, capsys):
+        assert 0 == self.run_sut(stamps, week)
+        assert customer in capsys.readouterr().out
+
+    @pytest.mark.parametrize('week', ['2', '-1'])
+    def test_week_out_of_range(self, stamps, week, capsys):
+        assert 1 == self.run_sut(stamps, week)
+        out, err = capsys.readouterr()
+        assert '' == out
+        assert 'week %s: the file has 2 reports\n' % week == err
+
+
+class TestRunReport(object):
+    @pytest.fixture
+    def stamps(self, tmpdir):
+        stamps = str(tmpdir.join('stamps'))
+        write_stamps(stamps, random_stamps(random.Random(1), days=100))
+        return stamps
+
+    def run_sut(self, arguments, capsys):
+        with patch.object(sys, 'argv', ['basename'] + arguments):
+            assert 0 == run_from_command_line()
+        return capsys.readouterr().out
+
+    def test_parallel(self, stamps, capsys):
+        expected = self.run_sut(['-f', stamps, '-j', '1'], capsys)
+        with patch('days_calc.parallel_report_lines',
+                   side_effect=parallel_report_lines) as pparallel:
+            arguments = ['-f', stamps, '-j', '2', '--parallel-threshold', '2']
+            assert expected == self.run_sut(arguments, capsys)
+        assert pparallel.called
+
+    @pytest.mark.parametrize('arguments', [
+        ['-j', '1', '--parallel-threshold', '0'],
+        ['-j', '2', '--parallel-threshold', '1000'],
+        ['-j', '2', '--parallel-threshold', '0', '0']])
+    def test_sequential(self, stamps, capsys, arguments):
+        with patch('days_calc.parallel_report_lines') as pparallel:
+            self.run_sut(['-f', stamps] + arguments, capsys)
+        assert not pparallel.called
+
+    def test_one_worker_per_cpu(self, stamps, capsys):
+        with patch('multiprocessing.cpu_count', return_value=1),\
+                patch('days_calc.report_ranges') as pranges:
+            self.run_sut(['-f', stamps], capsys)
+        assert not pranges.called
+
 
 class TestCmdlineArguments(object):
+    defaults = dict(
+        customer=None, file='user_folder!', week=None, workers=None,
+        parallel_threshold=None, check=False, recover=False, group_by=None,
+        rollup_cache=None, max_memory=None, merge=None, now=False,
+        watch=None)
+
     def run_sut(self, arguments):
         args = ['basename'] + arguments
         with patch.object(sys, 'argv', args),\
@@ -452,21 +1431,161 @@ class TestCmdlineArguments(object):
 
     def test_empty(self):
         args = self.run_sut([])
-        expected = dict(
-            customer=None, file='user_folder!', week=None)
-        assert expected == vars(args)
+        assert self.defaults == vars(args)
 
     def test_week(self):
         args = self.run_sut(['2'])
-        expected = dict(customer=None, file='user_folder!', week=2)
+        expected = dict(self.defaults, week=2)
         assert expected == vars(args)
 
     def test_customer(self):
         args = self.run_sut(['--customer', 'cust'])
-        expected = dict(customer='cust', file='user_folder!', week=None)
+        expected = dict(self.defaults, customer='cust')
         assert expected == vars(args)
 
     def test_file(self):
         args = self.run_sut(['--file', 'myfile'])
-        expected = dict(customer=None, file='myfile', week=None)
+        expected = dict(self.defaults, file='myfile')
+        assert expected == vars(args)
+
+    def test_workers(self):
+        args = self.run_sut(['-j', '4', '--parallel-threshold', '10'])
+        expected = dict(self.defaults, workers=4, parallel_threshold=10)
+        assert expected == vars(args)
+
+    def test_group_by(self):
+        args = self.run_sut(['--group-by', 'month', '--rollup-cache', 'rc'])
+        expected = dict(self.defaults, group_by='month', rollup_cache='rc')
+        assert expected == vars(args)
+
+    def test_max_memory(self):
+        args = self.run_sut(['--max-memory', '64'])
+        expected = dict(self.defaults, max_memory=64)
         assert expected == vars(args)
+
+    def test_merge(self):
+        args = self.run_sut(['--merge', 'a=f1', 'f2'])
+        expected = dict(self.defaults, merge=['a=f1', 'f2'])
+        assert expected == vars(args)
+
+    def test_now(self):
+        args = self.run_sut(['--now', '--watch', '2.5'])
+        expected = dict(self.defaults, now=True, watch=2.5)
+        assert expected == vars(args)
+
+    def test_check(self):
+        args = self.run_sut(['--check'])
+        expected = dict(self.defaults, check=True)
+        assert expected == vars(args)
+
+    def test_recover(self):
+        args = self.run_sut(['--recover', '-c', 'cust', '3'])
+        expected = dict(self.defaults, recover=True, customer='cust', week=3)
+        assert expected == vars(args)
+
+    @pytest.mark.parametrize('arguments', [
+        ['--now', '--check'],
+        ['--check', '--group-by', 'week'],
+        ['--group-by', 'week', '--merge', 'f1'],
+        ['--merge', 'f1', '--max-memory', '1'],
+        ['--max-memory', '0', '--now']])
+    def test_exclusive_modes(self, arguments, capsys):
+        with pytest.raises(SystemExit):
+            self.run_sut(arguments)
+        assert 'not allowed with argument' in capsys.readouterr().err
+
+    @pytest.mark.parametrize('arguments,message', [
+        (['--check', '--recover'],
+         'argument --recover: not used with --check'),
+        (['--now', '0'], 'argument week: not used with --now'),
+        (['--now', '-c', 'x'], 'argument --customer: not used with --now'),
+        (['2', '--merge', 'f1'], 'argument week: not used with --merge'),
+        (['--max-memory', '1', '--recover'],
+         'argument --recover: not used with --max-memory'),
+        (['--group-by', 'year', '--watch', '1'],
+         'argument --watch: not used with --group-by'),
+        (['--watch', '1'], 'argument --watch: needs --now'),
+        (['--rollup-cache', 'rc'],
+         'argument --rollup-cache: needs --group-by'),
+        (['--now', '-j', '4'], 'argument --workers: not used with --now'),
+        (['--check', '--parallel-threshold', '3'],
+         'argument --parallel-threshold: not used with --check')])
+    def test_unused_options(self, arguments, message, capsys):
+        with pytest.raises(SystemExit):
+            self.run_sut(arguments)
+        assert message in capsys.readouterr().err
+
+    @pytest.mark.parametrize('arguments,mode', [
+        ([], None),
+        (['2', '-c', 'x', '--recover'], None),
+        (['--now'], 'now'),
+        (['--check'], 'check'),
+        (['--group-by', 'week'], 'group_by'),
+        (['--merge', 'f1'], 'merge'),
+        (['--max-memory', '0', '1'], 'max_memory')])
+    def test_command_mode(self, arguments, mode):
+        assert mode == command_mode(self.run_sut(arguments))
+
+    def test_run_from_command_line(self):
+        runner = Mock(return_value=3)
+        with patch.dict(MODE_RUNNERS, check=runner),\
+                patch.object(sys, 'argv', ['basename', '--check', '-f', 'f']):
+            assert 3 == run_from_command_line()
+        args, = runner.call_args[0]
+        assert (True, 'f') == (args.check, args.file)
+
+
+@pytest.mark.parametrize('seed', range(25))
+@pytest.mark.parametrize('name', sorted(ENGINES))
+def test_engine_matches_reference(name, seed, tmpdir):
+    stamps = str(tmpdir.join('stamps'))
+    clean = str(tmpdir.join('clean'))
+    write_case(seed, stamps, clean)
+    assert not differs(name, stamps, clean)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_random_stamps_errors(seed, tmpdir):
+    stamps = str(tmpdir.join('stamps'))
+    expected = []
+    lines = random_stamps(random.Random(seed), invalid=0.05, errors=expected)
+    write_stamps(stamps, lines)
+    errors = []
+    parse_workstamps(stamps, errors)
+    assert expected == [error.lineno for error in errors]
+
+
+def test_without_bad_regions():
+    lines = [
+        '2001-01-01 08:00 start',
+        '2001-01-01 09:00 acme',
+        'restarttotals',
+        '2001-01-02 08:00 start',
+        '2001-01-02 0',
+        '2001-01-02 09:00 acme',
+        '',
+        'restarttotals',
+        '2001-01-03 08:00 start',
+        '2001-01-03 09:00 acme']
+    assert [
+        '2001-01-01 08:00 start',
+        '2001-01-01 09:00 acme',
+        'restarttotals',
+        '2001-01-03 08:00 start',
+        '2001-01-03 09:00 acme'] == without_bad_regions(lines, [4])
+
+
+@pytest.mark.parametrize('final_newline,expected', [
+    (True, 'restarttotals\nrestarttotals\n'),
+    (False, 'restarttotals\nrestarttotals')])
+def test_write_stamps(final_newline, expected, tmpdir):
+    stamps = tmpdir.join('stamps')
+    write_stamps(str(stamps), ['restarttotals'] * 2, final_newline)
+    assert expected == stamps.read()
+
+
+def test_differs(tmpdir):
+    stamps = str(tmpdir.join('stamps'))
+    write_stamps(stamps, random_stamps(random.Random(0)))
+    with patch.dict(ENGINES, broken=lambda filename: []):
+        assert differs('broken', stamps)